@@ -6,7 +6,8 @@ from scrapy import Request
 class SeleniumRequest(Request):
     """Scrapy ``Request`` subclass providing additional arguments"""
 
-    def __init__(self, wait_time=None, wait_until=None, screenshot=False, script=None, *args, **kwargs):
+    def __init__(self, wait_time=None, wait_until=None, screenshot=False, script=None,
+                 *args, skip_body=False, **kwargs):
         """Initialize a new selenium request
 
         Parameters
@@ -21,6 +22,9 @@ class SeleniumRequest(Request):
             will be returned in the response "meta" attribute.
         script: str
             JavaScript code to execute.
+        skip_body: bool
+            If True, the html of the page will not be read and the response body will be
+            empty, the page remains available through the driver in the "meta" attribute.
 
         """
 
@@ -28,5 +32,6 @@ class SeleniumRequest(Request):
         self.wait_until = wait_until
         self.screenshot = screenshot
         self.script = script
+        self.skip_body = skip_body
 
         super().__init__(*args, **kwargs)
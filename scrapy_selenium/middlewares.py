@@ -1,19 +1,263 @@
 """This module contains the ``SeleniumMiddleware`` scrapy middleware"""
-import zipfile
+import atexit
+import hashlib
+import inspect
+import io
+import json
+import os
+import signal
+import tempfile
+import weakref
+from collections.abc import Iterator
+from functools import lru_cache, partial
 from importlib import import_module
 
-from scrapy import signals
+from scrapy import Request, signals
 from scrapy.exceptions import NotConfigured
 from scrapy.http import HtmlResponse
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
+from twisted.internet.defer import DeferredQueue
+from twisted.internet.threads import deferToThread
 
 from .http import SeleniumRequest
 
 
+_MANIFEST_JSON = json.dumps(
+    {
+        'version': '1.0.0',
+        'manifest_version': 2,
+        'name': 'Chrome Proxy',
+        'permissions': [
+            'proxy',
+            'tabs',
+            'unlimitedStorage',
+            'storage',
+            '<all_urls>',
+            'webRequest',
+            'webRequestBlocking'
+        ],
+        'background': {
+            'scripts': ['background.js']
+        },
+        'minimum_chrome_version': '22.0.0'
+    },
+    separators=(',', ':')
+)
+
+_BACKGROUND_JS_TEMPLATE = """
+var config = {{
+    mode: 'fixed_servers',
+    rules: {{
+        singleProxy: {{
+            scheme: 'http',
+            host: {host},
+            port: {port}
+        }},
+        bypassList: ['localhost']
+    }}
+}};
+
+chrome.proxy.settings.set({{value: config, scope: 'regular'}}, function() {{}});
+
+function callbackFn(details) {{
+    return {{
+        authCredentials: {{
+            username: {user},
+            password: {pw}
+        }}
+    }};
+}}
+
+chrome.webRequest.onAuthRequired.addListener(
+    callbackFn,
+    {{urls: ['<all_urls>']}},
+    ['blocking']
+);
+"""
+
+# Read the url and the html of the page in a single driver round trip. Every top level
+# node is serialized, so the doctype and the comments around <html> are kept like in
+# ``page_source``
+_SNAPSHOT_SCRIPT = """
+var serializer = new XMLSerializer();
+var html = Array.prototype.map.call(document.childNodes, function(node) {
+    return node.nodeType === Node.ELEMENT_NODE
+        ? node.outerHTML
+        : serializer.serializeToString(node);
+}).join('');
+return [location.href, html];
+"""
+
+
+@lru_cache(maxsize=None)
+def _load_driver_klasses(driver_name):
+    """Import the ``WebDriver``, ``Options`` and ``Service`` classes of the given driver"""
+    webdriver_base_path = f'selenium.webdriver.{driver_name}'
+
+    driver_klass_module = import_module(f'{webdriver_base_path}.webdriver')
+    driver_klass = getattr(driver_klass_module, 'WebDriver')
+
+    driver_options_module = import_module(f'{webdriver_base_path}.options')
+    driver_options_klass = getattr(driver_options_module, 'Options')
+
+    driver_service_module = import_module(f'{webdriver_base_path}.service')
+    driver_service_klass = getattr(driver_service_module, 'Service')
+
+    return driver_klass, driver_options_klass, driver_service_klass
+
+
+def _build_driver_options(driver_name, browser_executable_path, driver_arguments):
+    """Return the ``Options`` of the given driver for the browser and arguments"""
+    _, driver_options_klass, _ = _load_driver_klasses(driver_name)
+
+    driver_options = driver_options_klass()
+
+    if browser_executable_path:
+        driver_options.binary_location = browser_executable_path
+
+    for argument in driver_arguments:
+        driver_options.add_argument(argument)
+
+    return driver_options
+
+
+# Middlewares whose drivers may still be running
+_live_middlewares = weakref.WeakSet()
+
+
+def _quit_live_drivers():
+    """Quit the drivers of every middleware still alive"""
+    for middleware in list(_live_middlewares):
+        try:
+            middleware.spider_closed()
+        except Exception:
+            pass
+
+
+def _handle_sigterm(signum, frame):
+    """Quit the live drivers then terminate the process like the default handler"""
+    _quit_live_drivers()
+
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def _install_sigterm_handler():
+    """Quit the live drivers on SIGTERM, unless another handler (such as scrapy's) is installed"""
+    if signal.getsignal(signal.SIGTERM) is not signal.SIG_DFL:
+        return
+
+    try:
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+    except ValueError:
+        # Signal handlers can only be installed from the main thread
+        pass
+
+
+# Do not leave driver processes behind if the spider_closed signal never fires
+atexit.register(_quit_live_drivers)
+
+
+def _add_cookies(driver, cookies):
+    """Add the cookies to the driver, with a single CDP call on chromium based drivers"""
+    if hasattr(driver, 'execute_cdp_cmd'):
+        # Scope the cookies like add_cookie does: to the current document, after any
+        # redirect, and to the root path
+        url = driver.current_url
+
+        driver.execute_cdp_cmd(
+            'Network.setCookies',
+            {
+                'cookies': [
+                    {
+                        'name': cookie_name,
+                        'value': cookie_value,
+                        'url': url,
+                        'path': '/'
+                    }
+                    for cookie_name, cookie_value in cookies.items()
+                ]
+            }
+        )
+        return
+
+    # The driver serializes the cookie as soon as it is sent, so a single dict is reused
+    cookie = {'name': None, 'value': None}
+
+    for cookie_name, cookie_value in cookies.items():
+        cookie['name'] = cookie_name
+        cookie['value'] = cookie_value
+        driver.add_cookie(cookie)
+
+
+def _pass_failure(failure):
+    """Default errback, letting the failure propagate like without an errback"""
+    return failure
+
+
+def _iterate_then_release(output, release):
+    """Yield the output of a spider callback then release the driver"""
+    try:
+        yield from output
+    finally:
+        release()
+
+
+def _release_after_callback(callback, release):
+    """Wrap a spider callback so the driver is released once its output has been consumed"""
+    if inspect.isasyncgenfunction(callback):
+        async def wrapper(*args, **kwargs):
+            try:
+                async for output in callback(*args, **kwargs):
+                    yield output
+            finally:
+                release()
+    elif inspect.iscoroutinefunction(callback):
+        async def wrapper(*args, **kwargs):
+            try:
+                return await callback(*args, **kwargs)
+            finally:
+                release()
+    else:
+        def wrapper(*args, **kwargs):
+            try:
+                output = callback(*args, **kwargs)
+            except BaseException:
+                release()
+                raise
+
+            if isinstance(output, Iterator):
+                return _iterate_then_release(output, release)
+
+            release()
+
+            return output
+
+    return wrapper
+
+
+def _restore_spider_callbacks(request):
+    """Release the driver still held by the request and restore its original callbacks"""
+    for name in ('callback', 'errback'):
+        checkout = getattr(getattr(request, name), 'selenium_checkout', None)
+
+        if checkout is not None:
+            original, release = checkout
+            release()
+            setattr(request, name, original)
+
+
+def _page_snapshot(driver):
+    """Return the current url of the driver and its html encoded to UTF-8 bytes"""
+    url, html = driver.execute_script(_SNAPSHOT_SCRIPT)
+    return url, html.encode('utf-8', 'replace')
+
+
 class SeleniumMiddleware:
     """Scrapy middleware handling the requests using selenium"""
 
+    # Paths of the proxy extensions already written on disk, by credentials
+    _ext_cache = {}
+
     def __init__(self,
                  driver_name,
                  driver_executable_path,
@@ -24,7 +268,9 @@ class SeleniumMiddleware:
                  proxy_host,
                  proxy_port,
                  proxy_user,
-                 proxy_pass
+                 proxy_pass,
+                 pool_size=1,
+                 wait_poll_frequency=0.05
                  ):
         """Initialize the selenium webdriver
 
@@ -50,101 +296,167 @@ class SeleniumMiddleware:
             The username to authenticate in the proxy server
         proxy_pass: str
             The password to authenticate in the proxy server
+        pool_size: int
+            The number of drivers to start and share between the requests
+        wait_poll_frequency: float
+            The number of seconds between two checks of the ``wait_until`` condition
         """
-        webdriver_base_path = f'selenium.webdriver.{driver_name}'
+        self.wait_poll_frequency = wait_poll_frequency
 
-        driver_klass_module = import_module(f'{webdriver_base_path}.webdriver')
-        driver_klass = getattr(driver_klass_module, 'WebDriver')
+        # Pick the driver factory once, it is then called for every driver of the pool
+        # proxy enabled
+        if proxy_enabled:
+            driver_factory = partial(
+                self._make_proxy_driver,
+                driver_name,
+                driver_executable_path,
+                browser_executable_path,
+                driver_arguments,
+                proxy_host,
+                proxy_port,
+                proxy_user,
+                proxy_pass
+            )
+        # locally installed driver
+        elif driver_executable_path is not None:
+            driver_factory = partial(
+                self._make_local_driver,
+                driver_name,
+                driver_executable_path,
+                browser_executable_path,
+                driver_arguments
+            )
+        # remote driver
+        elif command_executor is not None:
+            driver_factory = partial(
+                self._make_remote_driver,
+                driver_name,
+                command_executor,
+                browser_executable_path,
+                driver_arguments
+            )
+        else:
+            raise NotConfigured('Either a driver executable path or a command executor '
+                                'must be given')
+
+        # Start every driver upfront, the requests then check them out of the pool
+        drivers = []
+
+        try:
+            for _ in range(pool_size):
+                drivers.append(driver_factory())
+        except Exception:
+            # Do not leak the browsers already started
+            for driver in drivers:
+                driver.quit()
+            raise
+
+        self.drivers = drivers
+        self._pool = DeferredQueue()
+        for driver in self.drivers:
+            self._pool.put(driver)
+
+        _live_middlewares.add(self)
+        _install_sigterm_handler()
 
-        driver_options_module = import_module(f'{webdriver_base_path}.options')
-        driver_options_klass = getattr(driver_options_module, 'Options')
+    @classmethod
+    def _make_local_driver(cls, driver_name, driver_executable_path, browser_executable_path,
+                           driver_arguments):
+        """Start a locally installed driver"""
+        driver_klass, _, driver_service_klass = _load_driver_klasses(driver_name)
+
+        return driver_klass(
+            service=driver_service_klass(executable_path=driver_executable_path),
+            options=_build_driver_options(driver_name, browser_executable_path, driver_arguments)
+        )
 
-        driver_options = driver_options_klass()
+    @classmethod
+    def _make_proxy_driver(cls, driver_name, driver_executable_path, browser_executable_path,
+                           driver_arguments, proxy_host, proxy_port, proxy_user, proxy_pass):
+        """Start a locally installed driver going through the authenticated proxy"""
+        driver_klass, _, driver_service_klass = _load_driver_klasses(driver_name)
 
-        if browser_executable_path:
-            driver_options.binary_location = browser_executable_path
+        driver_options = _build_driver_options(
+            driver_name, browser_executable_path, driver_arguments
+        )
+        driver_options.add_extension(
+            cls._build_proxy_extension(proxy_host, proxy_port, proxy_user, proxy_pass)
+        )
 
-        for argument in driver_arguments:
-            driver_options.add_argument(argument)
+        return driver_klass(
+            service=driver_service_klass(executable_path=driver_executable_path),
+            options=driver_options
+        )
 
-        # proxy enabled
-        if proxy_enabled:
-            manifest_json = """
-            {
-                "version": "1.0.0",
-                "manifest_version": 2,
-                "name": "Chrome Proxy",
-                "permissions": [
-                    "proxy",
-                    "tabs",
-                    "unlimitedStorage",
-                    "storage",
-                    "<all_urls>",
-                    "webRequest",
-                    "webRequestBlocking"
-                ],
-                "background": {
-                    "scripts": ["background.js"]
-                },
-                "minimum_chrome_version":"22.0.0"
-            }
-            """
-
-            background_js = """
-            var config = {
-                mode: 'fixed_servers',
-                rules: {
-                    singleProxy: {
-                        scheme: 'http',
-                        host: '%s',
-                        port: parseInt(%s)
-                    },
-                    bypassList: ['localhost']
-                }
-            };
-
-            chrome.proxy.settings.set({value: config, scope: 'regular'}, function() {});
-
-            function callbackFn(details) {
-                return {
-                    authCredentials: {
-                        username: '%s',
-                        password: '%s'
-                    }
-                };
-            }
+    @classmethod
+    def _make_remote_driver(cls, driver_name, command_executor, browser_executable_path,
+                            driver_arguments):
+        """Start a driver on the selenium remote server"""
+        from selenium import webdriver
 
-            chrome.webRequest.onAuthRequired.addListener(
-                callbackFn,
-                {urls: ['<all_urls>']},
-                ['blocking']
-            );
-            """ % (proxy_host, proxy_port, proxy_user, proxy_pass)
+        return webdriver.Remote(
+            command_executor=command_executor,
+            options=_build_driver_options(driver_name, browser_executable_path, driver_arguments)
+        )
 
-            plugin_file = 'proxy_auth_plugin.zip'
+    def __del__(self):
+        """Quit the drivers left running when the middleware is garbage collected"""
+        try:
+            self.spider_closed()
+        except Exception:
+            pass
 
-            with zipfile.ZipFile(plugin_file, 'w') as zp:
-                zp.writestr('manifest.json', manifest_json)
-                zp.writestr('background.js', background_js)
+    @classmethod
+    def _build_proxy_extension(cls, host, port, user, pw):
+        """Return the path of the proxy authentication extension for the given credentials
 
-            driver_options.add_extension(plugin_file)
-            driver_kwargs = {
-                'executable_path': driver_executable_path,
-                'options': driver_options
-            }
-            self.driver = driver_klass(**driver_kwargs)
-        # locally installed driver
-        elif driver_executable_path is not None:
-            driver_kwargs = {
-                'executable_path': driver_executable_path,
-                'options': driver_options
-            }
-            self.driver = driver_klass(**driver_kwargs)
-        # remote driver
-        elif command_executor is not None:
-            capabilities = driver_options.to_capabilities()
-            self.driver = webdriver.Remote(command_executor=command_executor,
-                                           desired_capabilities=capabilities)
+        The extension is written at a path derived from its content in the temporary
+        directory, so the following calls and runs reuse the same file, while a change of
+        the templates never reuses a stale one.
+        """
+        key = (host, port, user, pw)
+        plugin_file = cls._ext_cache.get(key)
+
+        # The file may have been removed by a temporary directory cleaner in the meantime
+        if plugin_file is None or not os.path.exists(plugin_file):
+            import zipfile
+
+            # Insert the values as JSON literals, so quotes in them cannot break the script
+            background_js = _BACKGROUND_JS_TEMPLATE.format(
+                host=json.dumps(host),
+                port=int(port),
+                user=json.dumps(user),
+                pw=json.dumps(pw)
+            )
+
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(_MANIFEST_JSON.encode())
+            digest.update(background_js.encode())
+
+            plugin_file = os.path.join(
+                tempfile.gettempdir(), f'scrapy_selenium_proxy_{digest.hexdigest()}.zip'
+            )
+
+            if not os.path.exists(plugin_file):
+                # Build the archive in memory so it is written on disk in one go
+                buffer = io.BytesIO()
+
+                with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zp:
+                    zp.writestr('manifest.json', _MANIFEST_JSON)
+                    zp.writestr('background.js', background_js)
+
+                # Write next to the final path and move it in place, so concurrent
+                # processes never read a partially written extension
+                with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(plugin_file), suffix='.zip', delete=False
+                ) as tmp_file:
+                    tmp_file.write(buffer.getvalue())
+
+                os.replace(tmp_file.name, plugin_file)
+
+            cls._ext_cache[key] = plugin_file
+
+        return plugin_file
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -159,6 +471,8 @@ class SeleniumMiddleware:
         proxy_port = crawler.settings.get('SELENIUM_PROXY_PORT')
         proxy_user = crawler.settings.get('SELENIUM_PROXY_USER')
         proxy_pass = crawler.settings.get('SELENIUM_PROXY_PASS')
+        pool_size = crawler.settings.getint('SELENIUM_DRIVER_POOL_SIZE', 1)
+        wait_poll_frequency = crawler.settings.getfloat('SELENIUM_WAIT_POLL_FREQUENCY', 0.05)
 
         if driver_name is None:
             raise NotConfigured('SELENIUM_DRIVER_NAME must be set')
@@ -167,6 +481,13 @@ class SeleniumMiddleware:
             raise NotConfigured('Either SELENIUM_DRIVER_EXECUTABLE_PATH '
                                 'or SELENIUM_COMMAND_EXECUTOR must be set')
 
+        if proxy_enabled and proxy_port is None:
+            raise NotConfigured('SELENIUM_PROXY_PORT must be set when '
+                                'SELENIUM_PROXY_ENABLED is set')
+
+        if pool_size < 1:
+            raise NotConfigured('SELENIUM_DRIVER_POOL_SIZE must be at least 1')
+
         middleware = cls(
             driver_name=driver_name,
             driver_executable_path=driver_executable_path,
@@ -178,6 +499,8 @@ class SeleniumMiddleware:
             proxy_port=proxy_port,
             proxy_user=proxy_user,
             proxy_pass=proxy_pass,
+            pool_size=pool_size,
+            wait_poll_frequency=wait_poll_frequency,
         )
 
         crawler.signals.connect(middleware.spider_closed, signals.spider_closed)
@@ -185,43 +508,122 @@ class SeleniumMiddleware:
         return middleware
 
     def process_request(self, request, spider):
-        """Process a request using the selenium driver if applicable"""
-        if not isinstance(request, SeleniumRequest):
+        """Process a request using the selenium driver if applicable
+
+        The selenium calls are blocking, so they are run in the reactor thread pool to
+        let the reactor handle the other requests in the meantime.
+        """
+        # Most requests of a crawl are plain scrapy requests, reject them with a single
+        # identity check before falling back to isinstance for the other classes
+        if request.__class__ is Request or not isinstance(request, SeleniumRequest):
             return None
 
-        self.driver.get(request.url)
+        # A request coming back to the downloader (retried, redirected...) no longer needs
+        # the driver it held
+        _restore_spider_callbacks(request)
 
-        for cookie_name, cookie_value in request.cookies.items():
-            self.driver.add_cookie(
-                {
-                    'name': cookie_name,
-                    'value': cookie_value
-                }
-            )
+        # Wait for a driver on the reactor side, so no thread is parked until one is free
+        deferred = self._pool.get()
+        deferred.addCallback(self._process_with_driver, request, spider)
+
+        return deferred
+
+    def _process_with_driver(self, driver, request, spider):
+        """Process the request in a thread with the checked out driver"""
+        release = self._driver_release(driver)
+
+        deferred = deferToThread(self._do_selenium, driver, request)
+        deferred.addCallbacks(
+            self._hold_driver,
+            self._release_driver,
+            callbackArgs=(request, spider, release),
+            errbackArgs=(release,)
+        )
+
+        return deferred
+
+    def _driver_release(self, driver):
+        """Return a function putting the driver back in the pool the first time it is called"""
+        released = False
+
+        def release():
+            nonlocal released
+
+            if not released:
+                released = True
+                self._pool.put(driver)
+
+        return release
+
+    @staticmethod
+    def _hold_driver(response, request, spider, release):
+        """Keep the driver checked out until the spider is done with the response
+
+        The callback may use the driver exposed in the "meta" attribute, so no other request
+        can navigate it before the callback (or the errback) output has been consumed.
+        """
+        for name, default in (('callback', spider._parse), ('errback', _pass_failure)):
+            original = getattr(request, name)
+
+            wrapper = _release_after_callback(original or default, release)
+            wrapper.selenium_checkout = (original, release)
+
+            setattr(request, name, wrapper)
+
+        return response
+
+    @staticmethod
+    def _release_driver(failure, release):
+        """Put the driver back in the pool when the request failed and pass the failure through"""
+        release()
+
+        return failure
+
+    def _do_selenium(self, driver, request):
+        """Use the driver to process the request"""
+        driver.get(request.url)
+
+        if request.cookies:
+            _add_cookies(driver, request.cookies)
 
         if request.wait_until:
-            WebDriverWait(self.driver, request.wait_time).until(
-                request.wait_until
-            )
+            from selenium.webdriver.support.ui import WebDriverWait
+
+            WebDriverWait(
+                driver,
+                request.wait_time,
+                poll_frequency=self.wait_poll_frequency
+            ).until(request.wait_until)
 
         if request.screenshot:
-            request.meta['screenshot'] = self.driver.get_screenshot_as_png()
+            request.meta['screenshot'] = driver.get_screenshot_as_png()
 
         if request.script:
-            self.driver.execute_script(request.script)
+            driver.execute_script(request.script)
 
-        body = str.encode(self.driver.page_source)
+        if request.skip_body:
+            current_url = driver.current_url
+            body = b''
+        else:
+            current_url, body = _page_snapshot(driver)
 
-        # Expose the driver via the "meta" attribute
-        request.meta.update({'driver': self.driver})
+        # Expose the driver via the "meta" attribute, through a weak proxy so the
+        # responses do not keep the driver and its state alive
+        request.meta.update({'driver': weakref.proxy(driver)})
 
         return HtmlResponse(
-            self.driver.current_url,
+            current_url,
             body=body,
             encoding='utf-8',
             request=request
         )
 
     def spider_closed(self):
-        """Shutdown the driver when spider is closed"""
-        self.driver.quit()
+        """Shutdown the drivers when spider is closed"""
+        _live_middlewares.discard(self)
+        del self._pool.pending[:]
+
+        drivers, self.drivers = self.drivers, []
+
+        for driver in drivers:
+            driver.quit()
@@ -1,12 +1,25 @@
 """This module contains the test cases for the middlewares of the ``scrapy_selenium`` package"""
 
-from unittest.mock import patch
+import os
+import tempfile
+import weakref
+import zipfile
+from unittest.mock import Mock, patch
 
 from scrapy import Request
 from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
 
 from scrapy_selenium.http import SeleniumRequest
-from scrapy_selenium.middlewares import SeleniumMiddleware
+from scrapy_selenium.middlewares import (
+    SeleniumMiddleware,
+    _add_cookies,
+    _quit_live_drivers,
+    _restore_spider_callbacks
+)
 
 from .test_cases import BaseScrapySeleniumTestCase
 
@@ -26,6 +39,7 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
         )
 
         cls.selenium_middleware = SeleniumMiddleware.from_crawler(crawler)
+        cls.spider = cls.spider_klass()
 
     @classmethod
     def tearDownClass(cls):
@@ -33,7 +47,25 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
 
         super().tearDownClass()
 
-        cls.selenium_middleware.driver.quit()
+        cls.selenium_middleware.spider_closed()
+
+    def process_request(self, request):
+        """Run the ``process_request`` method of the middleware without the reactor thread pool"""
+
+        results = []
+
+        with patch('scrapy_selenium.middlewares.deferToThread', maybeDeferred):
+            deferred = self.selenium_middleware.process_request(request=request, spider=self.spider)
+
+        deferred.addBoth(results.append)
+
+        if isinstance(results[0], Failure):
+            results[0].raiseException()
+
+        # The driver is held until the spider is done with the response
+        self.addCleanup(_restore_spider_callbacks, request)
+
+        return results[0]
 
     def test_from_crawler_method_should_initialize_the_driver(self):
         """Test that the ``from_crawler`` method should initialize the selenium driver"""
@@ -46,13 +78,120 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
         selenium_middleware = SeleniumMiddleware.from_crawler(crawler)
 
         # The driver must be initialized
-        self.assertIsNotNone(selenium_middleware.driver)
+        self.assertEqual(len(selenium_middleware.drivers), 1)
 
         # We can now use the driver
-        selenium_middleware.driver.get('http://www.python.org')
-        self.assertIn('Python', selenium_middleware.driver.title)
+        driver = selenium_middleware.drivers[0]
+        driver.get('http://www.python.org')
+        self.assertIn('Python', driver.title)
+
+        selenium_middleware.spider_closed()
+
+    def test_from_crawler_method_should_initialize_the_driver_pool(self):
+        """Test that the ``from_crawler`` method should start as many drivers as the pool size"""
 
-        selenium_middleware.driver.close()
+        crawler = Crawler(
+            spidercls=self.spider_klass,
+            settings=dict(self.settings, SELENIUM_DRIVER_POOL_SIZE=2)
+        )
+
+        selenium_middleware = SeleniumMiddleware.from_crawler(crawler)
+
+        self.assertEqual(len(selenium_middleware.drivers), 2)
+        self.assertIsNot(selenium_middleware.drivers[0], selenium_middleware.drivers[1])
+
+        # Every driver runs its own service, quitting one must not stop the others
+        self.assertIsNot(
+            selenium_middleware.drivers[0].service,
+            selenium_middleware.drivers[1].service
+        )
+
+        selenium_middleware.spider_closed()
+
+    def test_from_crawler_method_should_require_the_proxy_port_if_proxy_enabled(self):
+        """Test that the ``from_crawler`` method should not accept a proxy without port"""
+
+        crawler = Crawler(
+            spidercls=self.spider_klass,
+            settings=dict(self.settings, SELENIUM_PROXY_ENABLED=True)
+        )
+
+        with self.assertRaises(NotConfigured):
+            SeleniumMiddleware.from_crawler(crawler)
+
+    def test_init_should_raise_not_configured_without_driver_path_nor_executor(self):
+        """Test that the middleware should not be configured without any way to start a driver"""
+
+        with self.assertRaises(NotConfigured):
+            SeleniumMiddleware(
+                driver_name='firefox',
+                driver_executable_path=None,
+                browser_executable_path=None,
+                command_executor=None,
+                driver_arguments=[],
+                proxy_enabled=False,
+                proxy_host=None,
+                proxy_port=None,
+                proxy_user=None,
+                proxy_pass=None
+            )
+
+    def test_init_should_quit_the_started_drivers_if_a_driver_fails_to_start(self):
+        """Test that the middleware should not leak the drivers of a pool that fails to start"""
+
+        started_driver = Mock()
+
+        with patch.object(
+            SeleniumMiddleware,
+            '_make_local_driver',
+            side_effect=[started_driver, RuntimeError('driver failed to start')]
+        ):
+            with self.assertRaises(RuntimeError):
+                SeleniumMiddleware(
+                    driver_name='firefox',
+                    driver_executable_path='geckodriver',
+                    browser_executable_path=None,
+                    command_executor=None,
+                    driver_arguments=[],
+                    proxy_enabled=False,
+                    proxy_host=None,
+                    proxy_port=None,
+                    proxy_user=None,
+                    proxy_pass=None,
+                    pool_size=2
+                )
+
+        started_driver.quit.assert_called_once()
+
+    def test_quit_live_drivers_should_quit_the_drivers_of_every_middleware(self):
+        """Test that the exit hook should quit the drivers of all the live middlewares"""
+
+        drivers = [Mock(), Mock()]
+
+        with patch.object(SeleniumMiddleware, '_make_local_driver', side_effect=drivers):
+            middlewares = [
+                SeleniumMiddleware(
+                    driver_name='firefox',
+                    driver_executable_path='geckodriver',
+                    browser_executable_path=None,
+                    command_executor=None,
+                    driver_arguments=[],
+                    proxy_enabled=False,
+                    proxy_host=None,
+                    proxy_port=None,
+                    proxy_user=None,
+                    proxy_pass=None
+                )
+                for _ in drivers
+            ]
+
+        with patch.object(self.selenium_middleware, 'spider_closed'):
+            _quit_live_drivers()
+
+        for driver in drivers:
+            driver.quit.assert_called_once()
+
+        self.assertEqual([middleware.drivers for middleware in middlewares], [[], []])
 
     def test_spider_closed_should_close_the_driver(self):
         """Test that the ``spider_closed`` method should close the driver"""
@@ -64,11 +203,91 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
 
         selenium_middleware = SeleniumMiddleware.from_crawler(crawler)
 
-        with patch.object(selenium_middleware.driver, 'quit') as mocked_quit:
+        driver = selenium_middleware.drivers[0]
+
+        with patch.object(driver, 'quit', wraps=driver.quit) as mocked_quit:
             selenium_middleware.spider_closed()
 
         mocked_quit.assert_called_once()
 
+    def test_spider_closed_should_only_close_the_driver_once(self):
+        """Test that the ``spider_closed`` method should not quit the drivers twice"""
+
+        crawler = Crawler(
+            spidercls=self.spider_klass,
+            settings=self.settings
+        )
+
+        selenium_middleware = SeleniumMiddleware.from_crawler(crawler)
+
+        driver = selenium_middleware.drivers[0]
+
+        with patch.object(driver, 'quit', wraps=driver.quit) as mocked_quit:
+            selenium_middleware.spider_closed()
+            selenium_middleware.spider_closed()
+
+        mocked_quit.assert_called_once()
+        self.assertEqual(selenium_middleware.drivers, [])
+
+    def test_build_proxy_extension_should_reuse_the_extension_file(self):
+        """Test that the ``_build_proxy_extension`` method should only write the extension once"""
+
+        plugin_file = SeleniumMiddleware._build_proxy_extension('localhost', 8080, 'user', 'pass')
+
+        with zipfile.ZipFile(plugin_file) as zp:
+            self.assertEqual(zp.namelist(), ['manifest.json', 'background.js'])
+            self.assertIn('host: "localhost"', zp.read('background.js').decode())
+
+        self.assertEqual(
+            SeleniumMiddleware._build_proxy_extension('localhost', 8080, 'user', 'pass'),
+            plugin_file
+        )
+        self.assertNotEqual(
+            SeleniumMiddleware._build_proxy_extension('localhost', 8080, 'user', 'other'),
+            plugin_file
+        )
+
+        # The extension file is shared with the following runs
+        with patch.dict(SeleniumMiddleware._ext_cache, clear=True):
+            self.assertEqual(
+                SeleniumMiddleware._build_proxy_extension('localhost', 8080, 'user', 'pass'),
+                plugin_file
+            )
+
+        self.assertTrue(plugin_file.startswith(tempfile.gettempdir()))
+
+    def test_build_proxy_extension_should_escape_the_credentials(self):
+        """Test that the credentials should be inserted as javascript string literals"""
+
+        plugin_file = SeleniumMiddleware._build_proxy_extension('h', 8080, 'u', "p'w\"")
+
+        with zipfile.ZipFile(plugin_file) as zp:
+            self.assertIn('password: "p\'w\\""', zp.read('background.js').decode())
+
+    def test_build_proxy_extension_should_rewrite_a_removed_extension_file(self):
+        """Test that the ``_build_proxy_extension`` method should not return a removed file"""
+
+        plugin_file = SeleniumMiddleware._build_proxy_extension('localhost', 8080, 'user', 'pass')
+        os.remove(plugin_file)
+
+        self.assertEqual(
+            SeleniumMiddleware._build_proxy_extension('localhost', 8080, 'user', 'pass'),
+            plugin_file
+        )
+        self.assertTrue(os.path.exists(plugin_file))
+
+    def test_build_proxy_extension_should_not_reuse_an_extension_of_another_template(self):
+        """Test that the extension file should depend on its content, not only the credentials"""
+
+        plugin_file = SeleniumMiddleware._build_proxy_extension('localhost', 8080, 'user', 'pass')
+
+        with patch.dict(SeleniumMiddleware._ext_cache, clear=True), \
+                patch('scrapy_selenium.middlewares._MANIFEST_JSON', '{}'):
+            self.assertNotEqual(
+                SeleniumMiddleware._build_proxy_extension('localhost', 8080, 'user', 'pass'),
+                plugin_file
+            )
+
     def test_process_request_should_return_none_if_not_selenium_request(self):
         """Test that the ``process_request`` should return none if not selenium request"""
 
@@ -81,28 +300,200 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
             )
         )
 
+    def test_process_request_should_return_a_deferred_if_selenium_request(self):
+        """Test that the ``process_request`` should not block the reactor on selenium requests"""
+
+        selenium_request = SeleniumRequest(url='http://www.python.org')
+
+        driver = self.selenium_middleware.drivers[0]
+
+        with patch('scrapy_selenium.middlewares.deferToThread') as mocked_defer_to_thread:
+            mocked_defer_to_thread.return_value = Deferred()
+
+            deferred = self.selenium_middleware.process_request(
+                request=selenium_request,
+                spider=self.spider
+            )
+
+        self.assertIsInstance(deferred, Deferred)
+        mocked_defer_to_thread.assert_called_once_with(
+            self.selenium_middleware._do_selenium,
+            driver,
+            selenium_request
+        )
+
+        # The driver goes back to the pool as soon as the processing failed
+        mocked_defer_to_thread.return_value.errback(RuntimeError('driver crashed'))
+        deferred.addErrback(lambda failure: None)
+        self.assertEqual(self.selenium_middleware._pool.pending, [driver])
+
+    def test_process_request_should_hold_the_driver_until_the_callback_is_done(self):
+        """Test that the ``process_request`` should only release the driver after the callback"""
+
+        def parse(response):
+            yield {'url': response.url}
+
+        selenium_request = SeleniumRequest(url='http://www.python.org', callback=parse)
+        response = HtmlResponse(selenium_request.url, body=b'', request=selenium_request)
+
+        with patch('scrapy_selenium.middlewares.deferToThread', maybeDeferred), \
+                patch.object(self.selenium_middleware, '_do_selenium', return_value=response):
+            self.selenium_middleware.process_request(
+                request=selenium_request,
+                spider=self.spider
+            )
+
+        self.assertEqual(self.selenium_middleware._pool.pending, [])
+
+        # The driver is still held while the callback output is being consumed
+        output = selenium_request.callback(response)
+        self.assertEqual(self.selenium_middleware._pool.pending, [])
+
+        self.assertEqual(list(output), [{'url': 'http://www.python.org'}])
+        self.assertEqual(len(self.selenium_middleware._pool.pending), 1)
+
+    def test_process_request_should_wait_for_a_free_driver_out_of_the_thread_pool(self):
+        """Test that the ``process_request`` should only start a thread once a driver is free"""
+
+        selenium_request = SeleniumRequest(url='http://www.python.org')
+
+        checked_out = self.selenium_middleware._pool.get()
+        driver = checked_out.result
+
+        with patch('scrapy_selenium.middlewares.deferToThread') as mocked_defer_to_thread:
+            mocked_defer_to_thread.return_value = Deferred()
+
+            deferred = self.selenium_middleware.process_request(
+                request=selenium_request,
+                spider=self.spider
+            )
+
+            mocked_defer_to_thread.assert_not_called()
+
+            self.selenium_middleware._pool.put(driver)
+
+        mocked_defer_to_thread.assert_called_once_with(
+            self.selenium_middleware._do_selenium,
+            driver,
+            selenium_request
+        )
+
+        mocked_defer_to_thread.return_value.errback(RuntimeError('driver crashed'))
+        deferred.addErrback(lambda failure: None)
+
     def test_process_request_should_return_a_response_if_selenium_request(self):
         """Test that the ``process_request`` should return a response if selenium request"""
 
         selenium_request = SeleniumRequest(url='http://www.python.org')
 
-        html_response = self.selenium_middleware.process_request(
-            request=selenium_request,
-            spider=None
-        )
+        html_response = self.process_request(selenium_request)
+
+        driver = self.selenium_middleware.drivers[0]
 
         # We have access to the driver on the response via the "meta"
-        self.assertEqual(
-            html_response.meta['driver'],
-            self.selenium_middleware.driver
+        self.assertEqual(html_response.meta['driver'], driver)
+
+        # Through a weak proxy only, the response does not keep the driver alive
+        self.assertIsInstance(html_response.meta['driver'], weakref.ProxyType)
+        self.assertFalse(
+            any(value is driver for value in html_response.meta.values())
         )
 
+        # The body keeps the doctype of the page
+        self.assertTrue(html_response.body.lower().startswith(b'<!doctype html>'))
+
         # We also have access to the "selector" attribute on the response
         self.assertEqual(
             html_response.selector.xpath('//title/text()').extract_first(),
             'Welcome to Python.org'
         )
 
+    def test_process_request_should_return_an_empty_body_if_skip_body_option(self):
+        """Test that the ``process_request`` should not read the html if skip body"""
+
+        selenium_request = SeleniumRequest(
+            url='http://www.python.org',
+            skip_body=True
+        )
+
+        html_response = self.process_request(selenium_request)
+
+        self.assertEqual(html_response.body, b'')
+        self.assertIn('python.org', html_response.url)
+
+    def test_process_request_should_hold_the_driver_of_a_skip_body_request(self):
+        """Test that another request should not navigate the driver before the callback is done"""
+
+        skip_body_request = SeleniumRequest(
+            url='http://www.python.org',
+            skip_body=True,
+            callback=lambda response: None
+        )
+        next_request = SeleniumRequest(url='http://www.python.org/about/')
+        next_results = []
+
+        with patch('scrapy_selenium.middlewares.deferToThread', maybeDeferred):
+            skip_body_response = self.process_request(skip_body_request)
+
+            self.selenium_middleware.process_request(
+                request=next_request,
+                spider=self.spider
+            ).addBoth(next_results.append)
+
+            # The next request waits while the callback may still read the page
+            self.assertEqual(next_results, [])
+            self.assertNotIn('/about/', skip_body_response.meta['driver'].current_url)
+
+            skip_body_request.callback(skip_body_response)
+
+        self.addCleanup(_restore_spider_callbacks, next_request)
+
+        self.assertIn('/about/', next_results[0].url)
+
+    def test_process_request_should_add_the_cookies_of_the_request(self):
+        """Test that the ``process_request`` should add the request cookies to the driver"""
+
+        selenium_request = SeleniumRequest(
+            url='http://www.python.org',
+            cookies={'scrapy_selenium': 'cookie_value'}
+        )
+
+        html_response = self.process_request(selenium_request)
+
+        self.assertEqual(
+            html_response.meta['driver'].get_cookie('scrapy_selenium')['value'],
+            'cookie_value'
+        )
+
+    def test_add_cookies_should_batch_the_cookies_with_cdp_on_chromium(self):
+        """Test that the cookies should be set with a single CDP call on chromium drivers"""
+
+        driver = Mock(spec=['execute_cdp_cmd', 'add_cookie', 'current_url'])
+        driver.current_url = 'https://www.python.org/a/b/page'
+
+        _add_cookies(driver, {'first': '1', 'second': '2'})
+
+        driver.execute_cdp_cmd.assert_called_once_with(
+            'Network.setCookies',
+            {
+                'cookies': [
+                    {
+                        'name': 'first',
+                        'value': '1',
+                        'url': 'https://www.python.org/a/b/page',
+                        'path': '/'
+                    },
+                    {
+                        'name': 'second',
+                        'value': '2',
+                        'url': 'https://www.python.org/a/b/page',
+                        'path': '/'
+                    }
+                ]
+            }
+        )
+        driver.add_cookie.assert_not_called()
+
     def test_process_request_should_return_a_screenshot_if_screenshot_option(self):
         """Test that the ``process_request`` should return a response with a screenshot"""
 
@@ -111,10 +502,7 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
             screenshot=True
         )
 
-        html_response = self.selenium_middleware.process_request(
-            request=selenium_request,
-            spider=None
-        )
+        html_response = self.process_request(selenium_request)
 
         self.assertIsNotNone(html_response.meta['screenshot'])
 
@@ -126,10 +514,7 @@ class SeleniumMiddlewareTestCase(BaseScrapySeleniumTestCase):
             script='document.title = "scrapy_selenium";'
         )
 
-        html_response = self.selenium_middleware.process_request(
-            request=selenium_request,
-            spider=None
-        )
+        html_response = self.process_request(selenium_request)
 
         self.assertEqual(
             html_response.selector.xpath('//title/text()').extract_first(),